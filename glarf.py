@@ -1,10 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import copy
+import functools
+import hashlib
 import os
-from typing import List, Dict, Optional
+import time
+from typing import Iterator, List, Dict, Optional
 import requests
 from SPARQLWrapper import SPARQLWrapper, JSON
+from SPARQLWrapper.SPARQLExceptions import EndPointInternalError
+import diskcache
+from rdflib import Literal
 from groq import Groq
 import networkx as nx
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from topk import top_k_indices
 from dataclasses import dataclass
 
 @dataclass
@@ -13,73 +24,129 @@ class MedicalEntity:
     label: str
     description: Optional[str]
     entity_type: str
-    related_entities: List[Dict]
+    # Parallel arrays: related_labels[i] is the label of related_uris[i]
+    related_uris: List[str]
+    related_labels: List[str]
     source_links: List[str]
 
+    @property
+    def related_entities(self) -> List[Dict]:
+        """Related entities as {"uri", "label"} dicts, the pre-parallel-array shape"""
+        return [{"uri": uri, "label": label}
+                for uri, label in zip(self.related_uris, self.related_labels)]
+
 class DBpediaMedicalGraphRAG:
     def __init__(self):
-        self.sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-        self.sparql.setReturnFormat(JSON)
+        self.sparql_endpoint = "http://dbpedia.org/sparql"
+        # Raw SPARQL JSON responses, keyed by a hash of the query text
+        self.query_cache = diskcache.Cache(".cache/dbpedia")
+        # Per-instance memo of parsed lookups, so the cache dies with the instance
+        self._entity_cache = functools.lru_cache(maxsize=1024)(self._query_medical_entity)
         self.groq_client = Groq(api_key=os.getenv('GROQ_API_KEY'))
         self.knowledge_graph = nx.DiGraph()
+        self.embedder = SentenceTransformer('all-MiniLM-L6-v2')
+        # Normalized label embeddings; row i belongs to node self._node_order[i]
+        self._label_matrix = np.empty((0, self.embedder.get_sentence_embedding_dimension()), dtype=np.float32)
+        self._node_order: List[str] = []
+        self._node_index: Dict[str, int] = {}
+        # Labels of each node's successors, filled lazily by generate_rag_context
+        self._neighbor_label_cache: Dict[str, List[str]] = {}
 
-    def query_medical_entity(self, search_term: str) -> MedicalEntity:
+    def _run_query(self, query: str, retries: int = 3) -> Dict:
+        """
+        Run a SPARQL query, using the on-disk cache and retrying endpoint errors
+        """
+        key = hashlib.sha256(query.encode("utf-8")).hexdigest()
+        cached = self.query_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # SPARQLWrapper is stateful, so each call gets its own to stay thread-safe
+        sparql = SPARQLWrapper(self.sparql_endpoint)
+        sparql.setReturnFormat(JSON)
+        sparql.setTimeout(30)
+        sparql.setQuery(query)
+        for attempt in range(retries + 1):
+            try:
+                results = sparql.query().convert()
+                break
+            except EndPointInternalError:
+                if attempt == retries:
+                    raise
+                time.sleep(2 ** attempt)
+
+        self.query_cache.set(key, results)
+        return results
+
+    def query_medical_entity(self, search_term: str) -> Optional[MedicalEntity]:
         """
         Query DBpedia for medical entities and their relationships
         """
+        entity = self._entity_cache(search_term)
+        # Callers get their own copy, never the memoized object
+        return copy.deepcopy(entity)
+
+    def _query_medical_entity(self, search_term: str) -> Optional[MedicalEntity]:
+        """
+        Uncached DBpedia lookup behind query_medical_entity
+        """
+        # Virtuoso free-text phrase; quotes would break the bif:contains syntax
+        term = search_term.replace("'", " ").replace('"', " ").strip()
+        if not term:
+            # bif:contains "''" is a syntax error, so there is nothing to look up
+            return None
+        phrase = "'%s'" % term
         query = """
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         PREFIX dbo: <http://dbpedia.org/ontology/>
         PREFIX dbp: <http://dbpedia.org/property/>
         
         SELECT DISTINCT ?entity ?label ?description ?type ?related ?relatedLabel WHERE {
-            ?entity rdfs:label ?label ;
-                    a ?type .
+            VALUES ?type { dbo:Disease dbo:Drug dbo:Protein dbo:AnatomicalStructure }
+            ?entity rdfs:label ?label .
+            ?label bif:contains %s .
+            FILTER(LANG(?label) = "en")
+            ?entity a ?type .
             OPTIONAL { 
                 ?entity dbo:abstract ?description .
                 FILTER(LANG(?description) = "en")
             }
             OPTIONAL {
-                ?entity ?relation ?related .
+                { ?entity dbo:drug ?related }
+                UNION { ?entity dbo:disease ?related }
+                UNION { ?entity dbo:protein ?related }
+                UNION { ?entity dbo:anatomicalStructure ?related }
                 ?related rdfs:label ?relatedLabel .
                 FILTER(LANG(?relatedLabel) = "en")
-                FILTER(?relation IN (dbo:drug, dbo:disease, dbo:protein, dbo:anatomicalStructure))
             }
-            FILTER(CONTAINS(LCASE(STR(?label)), LCASE(%s)))
-            FILTER(LANG(?label) = "en")
-            FILTER(?type IN (dbo:Disease, dbo:Drug, dbo:Protein, dbo:AnatomicalStructure))
         }
         LIMIT 10
-        """ % f'"{search_term}"'
-
-        self.sparql.setQuery(query)
-        results = self.sparql.query().convert()
-
-        # Process results into MedicalEntity
-        entity_data = {}
-        for result in results["results"]["bindings"]:
-            uri = result["entity"]["value"]
-            if uri not in entity_data:
-                entity_data[uri] = {
-                    "uri": uri,
-                    "label": result["label"]["value"],
-                    "description": result.get("description", {}).get("value"),
-                    "entity_type": result["type"]["value"].split("/")[-1],
-                    "related_entities": [],
-                    "source_links": [uri]  # DBpedia URI as source
-                }
-            
-            if "related" in result and "relatedLabel" in result:
-                entity_data[uri]["related_entities"].append({
-                    "uri": result["related"]["value"],
-                    "label": result["relatedLabel"]["value"]
-                })
-
-        # Convert to MedicalEntity object
-        if entity_data:
-            first_uri = next(iter(entity_data))
-            return MedicalEntity(**entity_data[first_uri])
-        return None
+        """ % Literal(phrase).n3()
+
+        results = self._run_query(query)
+
+        bindings = results["results"]["bindings"]
+        if not bindings:
+            return None
+
+        # Only the first entity is returned, so only its related rows are collected
+        first = bindings[0]
+        uri = first["entity"]["value"]
+        related_uris, related_labels = [], []
+        for result in bindings:
+            if result["entity"]["value"] == uri and "related" in result and "relatedLabel" in result:
+                related_uris.append(result["related"]["value"])
+                related_labels.append(result["relatedLabel"]["value"])
+
+        return MedicalEntity(
+            uri=uri,
+            label=first["label"]["value"],
+            description=first.get("description", {}).get("value"),
+            entity_type=first["type"]["value"].split("/")[-1],
+            related_uris=related_uris,
+            related_labels=related_labels,
+            source_links=[uri]  # DBpedia URI as source
+        )
 
     def update_knowledge_graph(self, entity: MedicalEntity):
         """
@@ -93,38 +160,85 @@ class DBpediaMedicalGraphRAG:
             description=entity.description
         )
 
-        # Add related entity nodes and edges
-        for related in entity.related_entities:
-            self.knowledge_graph.add_node(
-                related["uri"],
-                label=related["label"]
-            )
-            self.knowledge_graph.add_edge(entity.uri, related["uri"])
+        # Add related entity nodes and edges in bulk
+        self.knowledge_graph.add_nodes_from(
+            (uri, {'label': label})
+            for uri, label in zip(entity.related_uris, entity.related_labels)
+        )
+        self.knowledge_graph.add_edges_from(
+            (entity.uri, uri) for uri in entity.related_uris
+        )
 
-    def generate_rag_context(self, query: str) -> str:
+        # The entity gains successors, and relabeled nodes change their predecessors' lists
+        changed = [entity.uri] + entity.related_uris
+        for uri in changed:
+            self._neighbor_label_cache.pop(uri, None)
+            for predecessor in self.knowledge_graph.predecessors(uri):
+                self._neighbor_label_cache.pop(predecessor, None)
+
+        self._embed_labels(changed)
+
+    def _embed_labels(self, uris: List[str]):
         """
-        Generate RAG context from knowledge graph for Groq
+        Embed node labels in one batch and store them in the label matrix
+        """
+        uris = list(dict.fromkeys(uris))
+        labels = [self.knowledge_graph.nodes[uri].get('label', '') for uri in uris]
+        embeddings = self.embedder.encode(
+            labels,
+            batch_size=64,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        ).astype(np.float32)
+
+        new_rows = []
+        for uri, embedding in zip(uris, embeddings):
+            self.knowledge_graph.nodes[uri]['label_emb'] = embedding
+            if uri in self._node_index:
+                # Label may have changed, e.g. a related node later queried directly
+                self._label_matrix[self._node_index[uri]] = embedding
+            else:
+                self._node_index[uri] = len(self._node_order)
+                self._node_order.append(uri)
+                new_rows.append(embedding)
+        if new_rows:
+            self._label_matrix = np.vstack([self._label_matrix, np.stack(new_rows)])
+
+    def generate_rag_context(self, query: str, top_k: int = 10,
+                             min_similarity: Optional[float] = None) -> str:
+        """
+        Generate RAG context from knowledge graph for Groq, using the top_k nodes
+        by label similarity; pass min_similarity to also drop weaker matches
         """
         relevant_nodes = []
-        for node, data in self.knowledge_graph.nodes(data=True):
-            if any(term.lower() in data.get('label', '').lower() for term in query.lower().split()):
-                data['uri'] = node  # Add uri to node data
-                relevant_nodes.append(data)
+        k = min(top_k, len(self._node_order))
+        if k > 0:
+            q = self.embedder.encode(
+                [query], convert_to_numpy=True, normalize_embeddings=True
+            )[0].astype(np.float32)
+            sims = self._label_matrix @ q
+            relevant_nodes = [self._node_order[i] for i in top_k_indices(sims, k)
+                              if min_similarity is None or sims[i] >= min_similarity]
 
         context = "Medical Knowledge Context:\n\n"
-        for node_data in relevant_nodes:
+        for uri in relevant_nodes:
+            node_data = self.knowledge_graph.nodes[uri]
             context += f"- {node_data.get('label')}: {node_data.get('description', 'No description available')}\n"
             # Add connected entities
-            connected = [self.knowledge_graph.nodes[n]['label'] 
-                       for n in self.knowledge_graph.neighbors(node_data['uri'])]
+            connected = self._neighbor_label_cache.get(uri)
+            if connected is None:
+                connected = [self.knowledge_graph.nodes[n]['label']
+                             for n in self.knowledge_graph.neighbors(uri)]
+                self._neighbor_label_cache[uri] = connected
             if connected:
                 context += f"  Related: {', '.join(connected)}\n"
 
         return context
 
-    def query_with_rag(self, user_query: str) -> str:
+    def query_with_rag(self, user_query: str) -> Iterator[str]:
         """
-        Query the medical knowledge using RAG through Groq
+        Query the medical knowledge using RAG through Groq, yielding response text as it streams
         """
         context = self.generate_rag_context(user_query)
         
@@ -137,12 +251,20 @@ Include relevant relationships between medical entities and cite sources when po
 
 Response:"""
 
-        response = self.groq_client.chat.completions.create(
+        stream = self.groq_client.chat.completions.create(
             model="mixtral-8x7b-32768",
-            messages=[{"role": "user", "content": prompt}]
+            messages=[{"role": "user", "content": prompt}],
+            stream=True
         )
         
-        return response.choices[0].message.content
+        for chunk in stream:
+            yield chunk.choices[0].delta.content or ""
+
+    def query_with_rag_blocking(self, user_query: str) -> str:
+        """
+        Query the medical knowledge using RAG through Groq and return the full response
+        """
+        return "".join(self.query_with_rag(user_query))
 
 
 # Load environment variables at the start (incl API key)
@@ -160,9 +282,10 @@ def main():
         "pancreas"
     ]
     
-    # Build knowledge graph
-    for term in search_terms:
-        entity = rag_system.query_medical_entity(term)
+    # Build knowledge graph; lookups are I/O-bound, so run them concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        entities = list(executor.map(rag_system.query_medical_entity, search_terms))
+    for entity in entities:
         if entity:
             rag_system.update_knowledge_graph(entity)
     
@@ -170,8 +293,9 @@ def main():
     query = "What is the relationship between insulin and diabetes, and how does it affect the pancreas?"
     print(query)
     print(40 * "-")
-    response = rag_system.query_with_rag(query)
-    print(response)
+    for text in rag_system.query_with_rag(query):
+        print(text, end="", flush=True)
+    print()
 
 if __name__ == "__main__":
     main()
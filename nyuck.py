@@ -1,73 +1,336 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import aiohttp
 import networkx as nx
 from bs4 import BeautifulSoup
 import requests
-from typing import Dict, List
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import TYPE_CHECKING, Dict, List, Optional
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+import torch
+import joblib
+from numba import njit, prange
+from topk import top_k_indices
+
+if TYPE_CHECKING:
+    import faiss
+
+# all-MiniLM-L6-v2 truncates its input at 256 tokens, which this many characters covers
+MAX_TEXT_CHARS = 4096
+
+# flush() persists the embedding cache once this many new embeddings are unsaved;
+# call GraphRAG.save() to write the rest
+EMBEDDING_AUTOSAVE_MIN = 256
+
+# Below this many nodes query() scans the int8-quantized matrix (approximate, cosine
+# error around 1e-3) instead of building and searching an HNSW index
+ANN_MIN_NODES = 10000
+
+
+def quantize_int8(v: np.ndarray):
+    """Symmetric int8 quantization along the last axis; returns (codes, scales)."""
+    scales = np.maximum(np.abs(v).max(axis=-1), 1e-9) / 127.0
+    codes = np.round(v / scales[..., None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+@njit(fastmath=True, cache=True)
+def _dot(a, b):
+    """Dot product of two 1-d arrays, compiled to a single SIMD loop."""
+    s = 0.0
+    for i in range(a.shape[0]):
+        s += a[i] * b[i]
+    return s
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _matvec(M, q, out):
+    """out[i] = M[i] . q for every row, without materializing widened copies of M."""
+    for i in prange(M.shape[0]):
+        out[i] = _dot(M[i], q)
+
 
 class GraphRAG:
-    def __init__(self):
+    def __init__(self, embedding_cache_path: Optional[str] = None):
         self.graph = nx.Graph()
-        self.embedder = SentenceTransformer('all-MiniLM-L6-v2')
+        model_name = 'all-MiniLM-L6-v2'
+        if torch.cuda.is_available():
+            backend = 'cuda-fp16'
+            self.embedder = SentenceTransformer(model_name, device='cuda')
+            # FP16 forward pass; embeddings are cast back to FP32 after encode()
+            self.embedder.half()
+        else:
+            backend = 'onnx-cpu'
+            # On CPU, run the exported ONNX graph through onnxruntime instead of eager PyTorch
+            self.embedder = SentenceTransformer(
+                model_name,
+                device='cpu',
+                backend='onnx',
+                model_kwargs={'provider': 'CPUExecutionProvider'}
+            )
+        # Keep-alive session so repeat hosts reuse pooled connections
+        self._http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=64,
+            pool_maxsize=64,
+            max_retries=Retry(total=2, backoff_factor=0.3)
+        )
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
         self.content_cache: Dict[str, str] = {}
-        self.embedding_cache: Dict[str, np.ndarray] = {}
+        # Row-stacked, L2-normalized embeddings; row i belongs to self._urls[i].
+        # Buffers grow geometrically and only the first len(self._urls) rows are live.
+        dim = self.embedder.get_sentence_embedding_dimension()
+        self._emb_buf = np.empty((0, dim), dtype=np.float32)
+        self._urls: List[str] = []
+        self._row: Dict[str, int] = {}
+        # int8 copy of the embeddings with per-row scales, scanned by query()
+        self._emb_i8_buf = np.empty((0, dim), dtype=np.int8)
+        self._scales_buf = np.empty((0,), dtype=np.float32)
+        # HNSW index over _emb_matrix, built once the graph reaches ANN_MIN_NODES
+        self._index: Optional["faiss.Index"] = None
+        # Embeddings keyed by SHA-256 of the page text, persisted across runs. The
+        # default file is per model and backend so FP16 and ONNX vectors never mix.
+        # It is a pickle: only point embedding_cache_path at files you trust, since
+        # it is unpickled here. An unreadable file is treated as an empty cache.
+        if embedding_cache_path is None:
+            embedding_cache_path = os.path.join('.cache', f'embeddings-{model_name}-{backend}.joblib')
+        self.embedding_cache_path = embedding_cache_path
+        self._emb_by_hash: Dict[str, np.ndarray] = {}
+        self._unsaved_embeddings = 0
+        if os.path.exists(embedding_cache_path):
+            try:
+                self._emb_by_hash = joblib.load(embedding_cache_path)
+            except Exception as e:
+                print(f"Ignoring unreadable embedding cache {embedding_cache_path}: {str(e)}")
+        # URLs that have been scraped but not yet embedded, see flush()
+        self.pending_urls: List[str] = []
         
+    @property
+    def _emb_matrix(self) -> np.ndarray:
+        return self._emb_buf[:len(self._urls)]
+
+    @property
+    def _emb_matrix_i8(self) -> np.ndarray:
+        return self._emb_i8_buf[:len(self._urls)]
+
+    @property
+    def _scales(self) -> np.ndarray:
+        return self._scales_buf[:len(self._urls)]
+
+    @property
+    def embedding_cache(self) -> Dict[str, np.ndarray]:
+        """Per-URL embeddings, as views into the stacked matrix rather than copies."""
+        return dict(zip(self._urls, self._emb_matrix))
+
+    def _append_rows(self, urls: List[str], embeddings: np.ndarray):
+        """Append embeddings to the stacked buffers, doubling capacity when full."""
+        n, need = len(self._urls), len(self._urls) + len(urls)
+        if need > self._emb_buf.shape[0]:
+            capacity = max(need, 2 * self._emb_buf.shape[0], 16)
+            for name in ('_emb_buf', '_emb_i8_buf', '_scales_buf'):
+                old = getattr(self, name)
+                grown = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+                grown[:n] = old[:n]
+                setattr(self, name, grown)
+        codes, scales = quantize_int8(embeddings)
+        self._emb_buf[n:need] = embeddings
+        self._emb_i8_buf[n:need] = codes
+        self._scales_buf[n:need] = scales
+        self._row.update((url, n + i) for i, url in enumerate(urls))
+        self._urls.extend(urls)
+
+    def _extract_text(self, html: bytes) -> str:
+        """Extract the visible text from an HTML page."""
+        soup = BeautifulSoup(html, 'lxml')
+        
+        # Remove script and style elements
+        for script in soup(["script", "style"]):
+            script.decompose()
+            
+        # Get text content
+        text = soup.get_text(separator=' ', strip=True)
+        # Basic text cleaning
+        text = ' '.join(text.split())
+        return text[:MAX_TEXT_CHARS]
+
     def scrape_website(self, url: str) -> str:
         """Scrape content from a website."""
         try:
-            response = requests.get(url, timeout=10)
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            # Remove script and style elements
-            for script in soup(["script", "style"]):
-                script.decompose()
-                
-            # Get text content
-            text = soup.get_text(separator=' ', strip=True)
-            # Basic text cleaning
-            text = ' '.join(text.split())
-            return text
+            response = self._http.get(url, timeout=10)
+            return self._extract_text(response.content)
+        except Exception as e:
+            print(f"Error scraping {url}: {str(e)}")
+            return ""
+
+    async def _fetch(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, url: str,
+                     retries: int = 2, backoff_factor: float = 0.3) -> str:
+        """Fetch and parse one URL, retrying connection errors like scrape_website's Session does."""
+        try:
+            async with semaphore:
+                for attempt in range(retries + 1):
+                    try:
+                        async with session.get(url) as response:
+                            html = await response.read()
+                        break
+                    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                        if attempt == retries:
+                            raise
+                        await asyncio.sleep(backoff_factor * 2 ** attempt)
+            # Parsing runs in a worker thread so it overlaps outstanding requests
+            return await asyncio.to_thread(self._extract_text, html)
         except Exception as e:
             print(f"Error scraping {url}: {str(e)}")
             return ""
+
+    async def scrape_many(self, urls: List[str], concurrency: int = 100) -> Dict[str, str]:
+        """Scrape several websites concurrently."""
+        semaphore = asyncio.Semaphore(concurrency)
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            texts = await asyncio.gather(*[self._fetch(session, semaphore, u) for u in urls])
+        return dict(zip(urls, texts))
         
     def add_node(self, url: str):
-        """Add a node to the graph and scrape its content."""
-        if url not in self.graph:
-            content = self.scrape_website(url)
-            self.content_cache[url] = content
-            embedding = self.embedder.encode([content])[0]
-            self.embedding_cache[url] = embedding
-            self.graph.add_node(url, content=content, embedding=embedding)
+        """Scrape a URL and queue it for embedding; call flush() to add it to the graph."""
+        if url not in self.graph and url not in self.content_cache:
+            self.content_cache[url] = self.scrape_website(url)
+            self.pending_urls.append(url)
+
+    def add_nodes(self, urls: List[str]):
+        """Scrape several URLs concurrently and add them to the graph with one batched encode."""
+        new_urls = [u for u in dict.fromkeys(urls)
+                    if u not in self.graph and u not in self.content_cache]
+        if new_urls:
+            self.content_cache.update(asyncio.run(self.scrape_many(new_urls)))
+            self.pending_urls.extend(new_urls)
+        self.flush()
+
+    def flush(self):
+        """Embed all pending URLs in a single batch and add them to the graph."""
+        if not self.pending_urls:
+            return
+        # pending_urls is only cleared once the batch is stored, so a failed
+        # encode leaves these URLs queued for the next flush()
+        pending = self.pending_urls
+        hashes = [hashlib.sha256(self.content_cache[u].encode('utf-8')).hexdigest() for u in pending]
+        # Only run the encoder on page texts we have not embedded before
+        missing = {h: self.content_cache[u] for u, h in zip(pending, hashes)
+                   if h not in self._emb_by_hash}
+        if missing:
+            new_embeddings = self.embedder.encode(
+                list(missing.values()),
+                batch_size=128,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            ).astype(np.float32)
+            # Re-normalize after the FP32 cast; FP16 encoder output is only approximately unit-length
+            new_embeddings /= np.linalg.norm(new_embeddings, axis=1, keepdims=True) + 1e-12
+            self._emb_by_hash.update(zip(missing, new_embeddings))
+            self._unsaved_embeddings += len(missing)
+            if self._unsaved_embeddings >= EMBEDDING_AUTOSAVE_MIN:
+                self.save()
+        embeddings = np.stack([self._emb_by_hash[h] for h in hashes])
+        # Embeddings live only in the stacked buffers; see embedding_cache
+        self.graph.add_nodes_from(
+            (url, {'content': self.content_cache[url]}) for url in pending
+        )
+        self._append_rows(pending, embeddings)
+        if self._index is not None:
+            self._index.add(embeddings)
+        self.pending_urls = []
             
+    def save(self):
+        """Write the embedding cache to embedding_cache_path, atomically."""
+        directory = os.path.dirname(self.embedding_cache_path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        # Dump beside the target and rename over it, so a crash or a concurrent
+        # writer never leaves a truncated pickle in place
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                joblib.dump(self._emb_by_hash, f)
+            os.replace(tmp_path, self.embedding_cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._unsaved_embeddings = 0
+
     def add_edge(self, url1: str, url2: str, weight: float = None):
         """Add an edge between nodes with optional weight."""
-        if weight is None and url1 in self.embedding_cache and url2 in self.embedding_cache:
-            # Calculate similarity between nodes if weight not provided
-            sim = cosine_similarity(
-                [self.embedding_cache[url1]], 
-                [self.embedding_cache[url2]]
-            )[0][0]
-            weight = sim
+        self.flush()
+        if weight is None and url1 in self._row and url2 in self._row:
+            # Embeddings are L2-normalized, so cosine similarity is a plain dot product
+            weight = float(_dot(self._emb_buf[self._row[url1]], self._emb_buf[self._row[url2]]))
             
         self.graph.add_edge(url1, url2, weight=weight)
+
+    def connect_all(self, threshold: Optional[float] = None, block_size: int = 1024):
+        """Connect every pair of nodes, or only pairs whose similarity is at least threshold."""
+        self.flush()
+        n = len(self._urls)
+        if n < 2:
+            return
+        urls = np.array(self._urls, dtype=object)
+        # Pairwise similarities one row block at a time, so memory stays O(block_size * N)
+        for start in range(0, n - 1, block_size):
+            stop = min(start + block_size, n)
+            sims = self._emb_matrix[start:stop] @ self._emb_matrix[start:].T
+            # Upper triangle of the block: column offset start + c > row start + r
+            if threshold is None:
+                r, c = np.triu_indices(stop - start, 1, m=n - start)
+            else:
+                # Mask first so index arrays only cover the pairs that are kept
+                r, c = np.nonzero(np.triu(sims >= threshold, 1))
+            weights = sims[r, c]
+            self.graph.add_weighted_edges_from(
+                zip(urls[start + r], urls[start + c], weights.tolist())
+            )
         
     def query(self, query: str, top_k: int = 3) -> List[Dict]:
         """Query the graph and return most relevant nodes."""
-        query_embedding = self.embedder.encode([query])[0]
-        
-        similarities = []
-        for url in self.graph.nodes():
-            node_embedding = self.embedding_cache[url]
-            sim = cosine_similarity([query_embedding], [node_embedding])[0][0]
-            similarities.append((url, sim))
-            
-        # Sort by similarity and get top k results
-        similarities.sort(key=lambda x: x[1], reverse=True)
+        self.flush()
+        q = self.embedder.encode(
+            [query], convert_to_numpy=True, normalize_embeddings=True
+        )[0].astype(np.float32)
+
+        k = min(top_k, len(self._urls))
+        if k <= 0:
+            return []
+
+        if self._index is None and len(self._urls) >= ANN_MIN_NODES:
+            # Only large graphs need FAISS, so it is imported here rather than at module load
+            import faiss
+            self._index = faiss.IndexHNSWFlat(self._emb_matrix.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+            self._index.add(self._emb_matrix)
+
+        if self._index is not None:
+            # Approximate search; results come back sorted, -1 marks missing hits
+            # FAISS's default efSearch of 16 loses noticeable recall at this scale
+            self._index.hnsw.efSearch = max(64, k)
+            D, I = self._index.search(q[None], k)
+            found = I[0] >= 0
+            top_idx, top_sims = I[0][found], D[0][found]
+        else:
+            # One int8 matrix-vector pass over all nodes, rescaled to cosine
+            q_i8, q_scale = quantize_int8(q)
+            sims = np.empty(len(self._urls), dtype=np.float64)
+            _matvec(self._emb_matrix_i8, q_i8, sims)
+            sims *= self._scales * q_scale
+
+            top_idx = top_k_indices(sims, k)
+            top_sims = sims[top_idx]
+
         results = []
         
-        for url, sim in similarities[:top_k]:
+        for i, sim in zip(top_idx, top_sims):
+            url = self._urls[i]
+            sim = float(sim)
             # Get neighboring nodes
             neighbors = list(self.graph.neighbors(url))
             
@@ -93,13 +356,11 @@ if __name__ == "__main__":
     ]
     
     # Build the graph
-    for url in urls:
-        rag.add_node(url)
+    rag.add_nodes(urls)
+    rag.save()
     
     # Add edges between all nodes
-    for i in range(len(urls)):
-        for j in range(i+1, len(urls)):
-            rag.add_edge(urls[i], urls[j])
+    rag.connect_all()
     
     # Example query
     query = "What is Python programming?"
@@ -0,0 +1,15 @@
+import numpy as np
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first, in O(N + k log k)."""
+    n = scores.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty((0,), dtype=np.intp)
+    if k < n:
+        # Partition so the k largest land in the tail, without negating a copy of scores
+        idx = np.argpartition(scores, n - k)[n - k:]
+    else:
+        idx = np.arange(n)
+    return idx[np.argsort(-scores[idx])]